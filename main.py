@@ -1,12 +1,22 @@
 # Downloader for ubicast media servers
 
-from os.path import exists
+from pathlib import Path
+import asyncio
+import os
+import subprocess
 import sys
 import re
-import requests
+import httpx
 import json
 import ffmpeg
 
+# Precompiled patterns, so each call is a direct dispatch without a cache lookup
+_PERMALINK_STRIP_RE = re.compile(r"(.*/permalink/|/)")
+_VIDEOLINK_STRIP_RE = re.compile(r"(.*/videos/|/)")
+
+# Translation table mapping each forbidden filename character to a space
+_FORBIDDEN_TABLE = str.maketrans({c: " " for c in '\\/:*?"<>|'})
+
 
 def remove_forbidden_characters(string: str) -> str:
     """ Removes the forbidden characters from a string.
@@ -17,7 +27,7 @@ def remove_forbidden_characters(string: str) -> str:
     Returns:
         str: The requested string without the forbidden characters.
     """
-    return re.sub(r"(\\|\/|:|\*|\?|\"|<|>|\|)", " ", string).strip()
+    return string.translate(_FORBIDDEN_TABLE).strip()
 
 
 class UbicastDownloader:
@@ -29,9 +39,17 @@ class UbicastDownloader:
             api_key (str): The ubicast API key.
             verify (bool, optional): True if the connection must be secure, False otherwise. Defaults to False.
         """
-        self.__ubicast_server = ubicast_server
-        self.__api_key = api_key
-        self.__verify = verify
+        # Reuse one client so the TCP/TLS connection is kept alive between
+        # calls, with HTTP/2 multiplexing when the server supports it; the
+        # api_key is merged into the params of every request
+        self.__session = httpx.Client(
+            http2=True, verify=verify, base_url=ubicast_server,
+            params={"api_key": api_key},
+            limits=httpx.Limits(max_keepalive_connections=4, max_connections=16))
+
+        # Cache successful lookups so repeated URLs skip the network round trip
+        self.__oid_cache = {}
+        self.__modes_cache = {}
 
     def oid_from_permalink(self, url: str) -> str:
         """ Get the oid from an ubicast permalink URL.
@@ -49,7 +67,7 @@ class UbicastDownloader:
         if "/permalink/" not in url:
             raise ValueError("The requested URL is not a permalink.")
 
-        return re.sub(r"(.*/permalink/|/)", "", url)
+        return _PERMALINK_STRIP_RE.sub("", url)
 
     def oid_from_videolink(self, url: str) -> str:
         """ Get the oid from an ubicast videolink URL.
@@ -68,23 +86,22 @@ class UbicastDownloader:
         if "/videos/" not in url:
             raise ValueError("The requested URL is not a videolink.")
 
-        slug = re.sub(r"(.*/videos/|/)", "", url)
+        slug = _VIDEOLINK_STRIP_RE.sub("", url)
 
-        params = {"api_key": self.__api_key, "slug": slug}
+        if slug in self.__oid_cache:
+            return self.__oid_cache[slug]
 
-        # Try to get info from the server
-        try:
-            res = requests.get(
-                f"{self.__ubicast_server}/api/v2/medias/get/", params=params, verify=self.__verify)
-        except:
-            raise ConnectionError("The ubicast server is unreachable.")
+        media = self._fetch_media({"slug": slug})
 
         # Try to read the data
         try:
-            return json.loads(res.content)["info"]["oid"]
-        except:
+            oid = media["info"]["oid"]
+        except (KeyError, TypeError):
             raise ValueError("The data from the ubicast server is unreadable.")
 
+        self.__oid_cache[slug] = oid
+        return oid
+
     def get_oid(self, url: str) -> str:
         """ Get the oid of an ubicast URL.
 
@@ -105,8 +122,33 @@ class UbicastDownloader:
         else:
             raise ValueError("The requested URL is unrecognized.")
 
-    def get_oid_info(self, oid: str) -> dict:
-        """ Get informations about an oid.
+    def _fetch_media(self, params: dict) -> dict:
+        """ Get parsed media data from the /get/ endpoint of the ubicast server.
+
+        Args:
+            params (dict): The request parameters.
+
+        Raises:
+            ConnectionError: if the ubicast server is unreachable.
+            ValueError: if the data from the ubicast server is unreadable.
+
+        Returns:
+            dict: The parsed media data.
+        """
+        # Try to get info from the server
+        try:
+            res = self.__session.get("/api/v2/medias/get/", params=params)
+        except httpx.HTTPError:
+            raise ConnectionError("The ubicast server is unreachable.")
+
+        # Try to read the data
+        try:
+            return res.json()
+        except json.JSONDecodeError:
+            raise ValueError("The data from the ubicast server is unreadable.")
+
+    def _fetch_modes(self, oid: str) -> dict:
+        """ Get the raw modes data of an oid from the ubicast server.
 
         Args:
             oid (str): The requested oid.
@@ -116,50 +158,87 @@ class UbicastDownloader:
             ValueError: if the data from the ubicast server is unreadable.
 
         Returns:
-            dict: The oid informations.
+            dict: The raw modes data.
         """
-        params = {"api_key": self.__api_key,
-                  "oid": oid, "html5": "mp4_mp3_m3u8"}
+        if oid in self.__modes_cache:
+            return self.__modes_cache[oid]
+
+        params = {"oid": oid, "html5": "mp4_mp3_m3u8"}
 
         # Try to get the video info from the server
         try:
-            res = requests.get(
-                f"{self.__ubicast_server}/api/v2/medias/modes/", params=params, verify=self.__verify)
-        except:
+            res = self.__session.get("/api/v2/medias/modes/", params=params)
+        except httpx.HTTPError:
             raise ConnectionError("The ubicast server is unreachable.")
 
         # Try to read the data
         try:
-            info = json.loads(res.content)
-
-            # Create video info
-            video_tracks = info["names"] if "names" in info else []
-            if "audio" in video_tracks:
-                video_tracks.remove("audio")
-
-            # Get audio info
-            audio_tracks = []
-            if (
-                "audio" in info
-                and info["audio"] is not None
-                and "tracks" in info["audio"]
-                and info["audio"]["tracks"] is not None
-            ):
-                for track in info["audio"]["tracks"]:
-                    audio_tracks.append(
-                        {
-                            "language": track["language"] if "language" in track else None,
-                            "title": track["title"] if "title" in track else None,
-                        }
-                    )
-
-            # Return the info
-            return {"video": video_tracks, "audio": audio_tracks}
-        except:
+            info = res.json()
+        except json.JSONDecodeError:
             raise ValueError("The data from the ubicast server is unreadable.")
 
-    def download(self, oid: str, path: str, video_track_name: str = None, audio_track_id: int = None,  extension: str = ".mp4"):
-        """ Download a file from the ubicast server.
+        self.__modes_cache[oid] = info
+        return info
+
+    @staticmethod
+    def _parse_tracks(info: dict) -> dict:
+        """ Extract the video and audio tracks from raw modes data.
+
+        Args:
+            info (dict): The raw modes data.
+
+        Returns:
+            dict: The video and audio tracks.
+        """
+        # Create video info, copying the list so the raw dict is not mutated
+        video_tracks = list(info.get("names") or [])
+        if "audio" in video_tracks:
+            video_tracks.remove("audio")
+
+        # Get audio info
+        audio = info.get("audio") or {}
+        audio_tracks = [
+            {"language": track.get("language"), "title": track.get("title")}
+            for track in (audio.get("tracks") or [])
+        ]
+
+        # Return the info
+        return {"video": video_tracks, "audio": audio_tracks}
+
+    def get_oid_info(self, oid: str) -> dict:
+        """ Get informations about an oid.
+
+        Args:
+            oid (str): The requested oid.
+
+        Raises:
+            ConnectionError: if the ubicast server is unreachable.
+            ValueError: if the data from the ubicast server is unreadable.
+
+        Returns:
+            dict: The oid informations.
+        """
+        return self._parse_tracks(self._fetch_modes(oid))
+
+    @staticmethod
+    def _input_options(url: str) -> dict:
+        """ Get the ffmpeg input options suited to a resource URL.
+
+        Args:
+            url (str): The resource URL.
+
+        Returns:
+            dict: The ffmpeg input options.
+        """
+        # Keep the HTTP connection alive between HLS segment fetches instead
+        # of paying a TLS handshake per segment. These are HLS demuxer
+        # options: ffmpeg rejects them on plain mp4/mp3 inputs.
+        if url.partition("?")[0].endswith(".m3u8"):
+            return {"http_persistent": 1, "http_multiple": 1}
+        return {}
+
+    def _prepare_stream(self, oid: str, path: str, video_track_name: str = None, audio_track_id: int = None, extension: str = ".mp4"):
+        """ Validate the download parameters and build the ffmpeg stream.
 
         Args:
             oid (str): The requested oid.
@@ -172,16 +251,21 @@ class UbicastDownloader:
             NotADirectoryError: if the path is invalid.
             ValueError: if a parameters has an invalid value or if the data from the ubicast server is unreadable.
             ConnectionError: if the ubicast server is unreachable.
+
+        Returns:
+            tuple: The ffmpeg stream to run and the reserved output filepath.
         """
         # Value Checking
-        if not exists(path):
+        path = Path(path)
+        if not path.is_dir():
             raise NotADirectoryError("The path is invalid.")
         if video_track_name is None and audio_track_id is None:
             raise ValueError(
                 "There must be a video track or an audio track selected.")
 
         # Get the video info
-        dict_vid = self.get_oid_info(oid)
+        info = self._fetch_modes(oid)
+        dict_vid = self._parse_tracks(info)
 
         # Value Checking
         if video_track_name is not None and len(dict_vid["video"]) == 0:
@@ -197,48 +281,118 @@ class UbicastDownloader:
             raise ValueError("The chosen audio track is invalid.")
 
         # Get the title
-        params1 = {"api_key": self.__api_key, "oid": oid}
-        params2 = {"api_key": self.__api_key,
-                   "oid": oid, "html5": "mp4_mp3_m3u8"}
+        media = self._fetch_media({"oid": oid})
 
         try:
-            res1 = requests.get(
-                f"{self.__ubicast_server}/api/v2/medias/get/", params=params1, verify=self.__verify)
-            res2 = requests.get(
-                f"{self.__ubicast_server}/api/v2/medias/modes/", params=params2, verify=self.__verify)
-        except:
-            raise ConnectionError("The ubicast server is unreachable.")
-
-        try:
-            title = remove_forbidden_characters(
-                json.loads(res1.content)["info"]["title"])
-            info = json.loads(res2.content)
-        except:
+            title = remove_forbidden_characters(media["info"]["title"])
+        except (KeyError, TypeError):
             raise ValueError("The data from the ubicast server is unreadable.")
 
-        # Create the filepath
-        filepath = f"{path}/{title}{extension}"
+        # Create the filepath, scanning the directory once to avoid collisions.
+        # The chosen name is reserved by creating the file exclusively, so
+        # concurrent downloads of the same title cannot pick the same name.
+        existing = {entry.name for entry in os.scandir(path)}
+        filename = f"{title}{extension}"
         number = 0
-        while exists(filepath):
-            filepath = f"{path}/{title} ({number}){extension}"
+        while True:
+            if filename not in existing:
+                try:
+                    (path / filename).touch(exist_ok=False)
+                    break
+                except FileExistsError:
+                    pass
+            filename = f"{title} ({number}){extension}"
             number += 1
+        filepath = path / filename
 
         # Create the args
         args = []
         if video_track_name is not None:
             video_url = info[video_track_name]["resource"]["url"]
-            args.append(ffmpeg.input(video_url))
+            args.append(ffmpeg.input(video_url, **self._input_options(video_url)))
 
         if audio_track_id is not None:
             audio_url = info["audio"]["tracks"][audio_track_id]["url"]
-            args.append(ffmpeg.input(audio_url))
+            args.append(ffmpeg.input(audio_url, **self._input_options(audio_url)))
+
+        # ffmpeg-python only accepts a str filename, not a Path
+        args.append(str(filepath))
+
+        return ffmpeg.output(*args, codec="copy"), filepath
 
-        args.append(filepath)
+    @staticmethod
+    def _ffmpeg_command(stream) -> list:
+        """ Compile an ffmpeg stream into a command line.
 
-        stream = ffmpeg.output(*args, codec="copy")
+        Args:
+            stream (Stream): The ffmpeg stream to compile.
+
+        Returns:
+            list: The ffmpeg command line, with stdin disabled.
+        """
+        command = ffmpeg.compile(stream)
+        # -nostdin stops ffmpeg from polling the terminal for commands and -y
+        # lets it overwrite the empty file reserving the output name
+        command[1:1] = ["-nostdin", "-y"]
+        return command
+
+    def download(self, oid: str, path: str, video_track_name: str = None, audio_track_id: int = None,  extension: str = ".mp4"):
+        """ Download a file from the ubicast server.
+
+        Args:
+            oid (str): The requested oid.
+            path (str): The download path.
+            video_track_name (str, optional): The video track name. Defaults to None.
+            audio_track_id (int, optional): The audio track id. Defaults to None.
+            extension (str, optional): The file extension. Defaults to ".mp4".
+
+        Raises:
+            NotADirectoryError: if the path is invalid.
+            ValueError: if a parameters has an invalid value or if the data from the ubicast server is unreadable.
+            ConnectionError: if the ubicast server is unreachable.
+            subprocess.CalledProcessError: if ffmpeg fails.
+        """
+        stream, filepath = self._prepare_stream(
+            oid, path, video_track_name, audio_track_id, extension)
+
+        # Try to download
+        try:
+            subprocess.run(self._ffmpeg_command(stream),
+                           stdin=subprocess.DEVNULL, check=True)
+        except subprocess.CalledProcessError:
+            filepath.unlink(missing_ok=True)
+            raise
+
+    async def download_async(self, oid: str, path: str, video_track_name: str = None, audio_track_id: int = None, extension: str = ".mp4"):
+        """ Download a file from the ubicast server without blocking the event loop.
+
+        The metadata calls run in a worker thread on the shared session and
+        ffmpeg runs as an asyncio subprocess, so several downloads can be
+        driven concurrently.
+
+        Args:
+            oid (str): The requested oid.
+            path (str): The download path.
+            video_track_name (str, optional): The video track name. Defaults to None.
+            audio_track_id (int, optional): The audio track id. Defaults to None.
+            extension (str, optional): The file extension. Defaults to ".mp4".
+
+        Raises:
+            NotADirectoryError: if the path is invalid.
+            ValueError: if a parameters has an invalid value or if the data from the ubicast server is unreadable.
+            ConnectionError: if the ubicast server is unreachable.
+            RuntimeError: if ffmpeg fails.
+        """
+        stream, filepath = await asyncio.to_thread(
+            self._prepare_stream, oid, path, video_track_name, audio_track_id, extension)
 
         # Try to download
-        ffmpeg.run(stream)
+        process = await asyncio.create_subprocess_exec(
+            *self._ffmpeg_command(stream), stdin=asyncio.subprocess.DEVNULL)
+        returncode = await process.wait()
+        if returncode != 0:
+            filepath.unlink(missing_ok=True)
+            raise RuntimeError(f"ffmpeg exited with code {returncode}.")
 
 
 def choice(options: list, prompt: str):
@@ -251,38 +405,32 @@ def choice(options: list, prompt: str):
     Returns:
         Any: The selected option from the list.
     """
-    i = 1
-    for option in options:
-        print(f"{option} : {i}")
-        i = i + 1
+    menu = "\n".join(f"{option} : {i}" for i,
+                     option in enumerate(options, start=1))
+    choices = {str(c) for c in range(1, len(options) + 1)}
 
-    choices = [str(c) for c in range(1, len(options) + 1)]
+    print(menu)
 
     while True:
         output = input(prompt)
         if output in choices:
-            output = int(output) - 1
-            output = options[output]
-            return output
+            return options[int(output) - 1]
         else:
             print("Bad option. Options: " + ", ".join(options))
 
 
-if __name__ == "__main__":
-    if len(sys.argv) == 1:
-        print(f"Usage: {sys.argv[0]} <link> [, <link>, <link>, <link>, ...]")
-        exit()
+async def main(ubidl: UbicastDownloader, urls: list):
+    """ Download the requested URLs concurrently.
 
-    # Read the config file
-    with open("config.json") as config_file:
-        config = json.load(config_file)
-        api_key = config["api_key"]
-        ubicast_server = config["ubicast_server"]
-        verify = config["verify"] if "verify" in config else False
-
-    ubidl = UbicastDownloader(ubicast_server, api_key, verify)
+    The track choices are asked up-front, one URL at a time, then the
+    downloads run concurrently with at most 4 in flight.
 
-    urls = sys.argv[1:]
+    Args:
+        ubidl (UbicastDownloader): The downloader to use.
+        urls (list): The requested URLs.
+    """
+    # Choose the tracks for each url
+    downloads = []
     for url in urls:
         try:
             # Get the url oid
@@ -295,11 +443,42 @@ if __name__ == "__main__":
             video_track_name = choice(dict_vid["video"], "Choose a stream: ")
             audio_track_id = 0 if len(dict_vid["audio"]) > 0 else None
 
-            # Download
-            ubidl.download(oid, "./", video_track_name, audio_track_id)
-
-        except KeyboardInterrupt:
-            exit(1)
+            downloads.append((oid, video_track_name, audio_track_id))
 
         except Exception as err:
             print(err)
+
+    # Download concurrently
+    semaphore = asyncio.Semaphore(4)
+
+    async def download(oid, video_track_name, audio_track_id):
+        async with semaphore:
+            try:
+                await ubidl.download_async(
+                    oid, "./", video_track_name, audio_track_id)
+            except Exception as err:
+                print(err)
+
+    async with asyncio.TaskGroup() as tg:
+        for download_args in downloads:
+            tg.create_task(download(*download_args))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1:
+        print(f"Usage: {sys.argv[0]} <link> [, <link>, <link>, <link>, ...]")
+        exit()
+
+    # Read the config file
+    with open("config.json") as config_file:
+        config = json.load(config_file)
+        api_key = config["api_key"]
+        ubicast_server = config["ubicast_server"]
+        verify = config["verify"] if "verify" in config else False
+
+    ubidl = UbicastDownloader(ubicast_server, api_key, verify)
+
+    try:
+        asyncio.run(main(ubidl, sys.argv[1:]))
+    except KeyboardInterrupt:
+        exit(1)